@@ -8,13 +8,23 @@ import re
 import dataclasses
 from textwrap import dedent
 import tempfile
-import shutil
+import functools
+import hashlib
+import io
+import os
 
 import click  # dnf install python3-click
 
 
 REPO_KEY = 'importpatches.upstream'
-PATCH_NUMBER_RE = re.compile('^(\d+):')
+CACHE_DIR = Path(
+    os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+) / 'importpatches'
+PATCH_NUMBER_RE = re.compile(r'^(\d+):')
+PATCH_NUM_IN_BODY_RE = re.compile(r'\d{5,}')
+CHERRY_PICKED_RE = re.compile(r'\(cherry picked from commit .{40}\)')
+COAUTHOR_RE = re.compile(r'co-authored-by:', re.IGNORECASE)
+SLUGIFY_RE = re.compile('[^a-z0-9_-]+')
 SPECIAL_PATCH_NUMBERS = {
     'python-2.7.1-config.patch': 0,
     'python-2.6-rpath.patch': 16,
@@ -27,7 +37,15 @@ PATCH_SECTION_STARTS = {
     '# Modules/Setup.dist is ultimately used by the "makesetup" script to construct'
 }
 PATCH_SECTION_END = '# (New patches go here ^^^)'
+EXISTING_PATCH_RE = re.compile(r'^(\d+)-.*\.patch$')
 FLIENAME_SAFE_RE = re.compile('^[a-zA-Z0-9._-]+$')
+PATCH_ID_COMMIT_RE = re.compile(rb'(?:commit |From )?[0-9a-f]{40}', re.I)
+HUNK_HEADER_RE = re.compile(
+    rb'@@ -\d*(?:,(?P<before>\d*))? \+\d*(?:,(?P<after>\d*))?'
+)
+COMMIT_ID_RE = re.compile('[0-9a-f]{40}|[0-9a-f]{64}')
+VERSION_RE = re.compile(r'\d+(?:\.\d+)*')
+RELEASE_RE = re.compile(r'Release:\s*([0-9]+)%\{\?dist\}$')
 SOURCE_PATCH_RE = re.compile(r'^Source\d*:\s*(?P<filename>\S+\.patch)')
 KEEP_PATCHES = {
     # These python2 patches are special
@@ -35,7 +53,9 @@ KEEP_PATCHES = {
     '05000-autotool-intermediates.patch',
 }
 
-BUNDLED_VERSION_RE = re.compile('-_([A-Z]+)_VERSION = "([0-9.]+)"')
+BUNDLED_VERSION_RE = re.compile(
+    r'^-_([A-Z]+)_VERSION = "([0-9.]+)"', re.MULTILINE
+)
 BUNDLED_VERSION_BLURB = """
 # The following versions of setuptools/pip are bundled when this patch is not applied.
 # The versions are written in Lib/ensurepip/__init__.py, this patch removes them.
@@ -50,13 +70,19 @@ ABBREV = {
     ...: 10,
 }
 
+GIT_TOO_OLD_MESSAGE = (
+    'Unexpected output from git rev-list; Git 2.33 or newer is needed'
+)
 
-def removeprefix(self, prefix):
-    # PEP-616 backport
-    if self.startswith(prefix):
-        return self[len(prefix):]
-    else:
-        return self
+# Buffer size for files written in many small pieces
+IO_BUFFER_SIZE = 128 * 1024
+
+# ANSI escape sequences for the colors used in output
+STYLE_RESET = click.style('', reset=True)
+STYLES = {
+    color: click.style('', fg=color, reset=False)
+    for color in ('cyan', 'green', 'red', 'yellow')
+}
 
 
 @dataclasses.dataclass
@@ -69,18 +95,85 @@ class PatchInformation:
     trailer: str = ''
 
 
-def handle_patch(repo, commit_id, *, tempdir, python_version):
-    """Handle a single patch, writing it to `tempdir` and returning info
+@dataclasses.dataclass
+class SpecInformation:
+    """All information needed from the spec file"""
+    rpm_globals: list = dataclasses.field(default_factory=list)
+    upstream_version: str = None
+    source_patches: set = dataclasses.field(default_factory=set)
+    release_lines: list = dataclasses.field(default_factory=list)
+
+    @property
+    def literal_release(self):
+        """The release number if it can be read without rpm, or None
+
+        That is the case for a single `Release: N%{?dist}` line.
+        """
+        if len(self.release_lines) == 1:
+            if match := RELEASE_RE.match(self.release_lines[0]):
+                return match.group(1)
+        return None
+
+
+def scan_spec(spec_lines):
+    """Collect information from lines of the spec file in a single pass
+
+    Lines are dispatched on their first character, so most lines are
+    skipped after a single comparison.
     """
-    message = run(
-        'git', 'show', '-s', '--format=%B', commit_id,
-        cwd=repo,
-    ).stdout.strip()
+    info = SpecInformation()
+    for line in spec_lines:
+        # Directives we look for start at column 0; only the line end
+        # needs to be trimmed
+        line = line.rstrip()
+        first = line[:1]
+        if first == '%':
+            # %global definitions after upstream_version are not needed
+            # to expand it
+            if info.upstream_version is not None:
+                continue
+            directive, *definition = line.split(None, 2)
+            if directive != '%global' or not definition:
+                continue
+            if '%{expand:' not in line:
+                info.rpm_globals.append(' '.join(definition))
+            if definition[0] == 'upstream_version':
+                info.upstream_version = ''.join(definition[1:])
+        elif first == 'S':
+            if match := SOURCE_PATCH_RE.match(line):
+                info.source_patches.add(match.group('filename'))
+        elif first == 'R':
+            if line.startswith('Release:'):
+                info.release_lines.append(line)
+    return info
+
+
+def style(text, fg):
+    """Like click.style, but with escape sequences computed up front"""
+    return STYLES[fg] + text + STYLE_RESET
+
+
+def secho(message, fg):
+    """Like click.secho, but with escape sequences computed up front"""
+    click.echo(style(message, fg=fg))
+
+
+def handle_patch(
+    commit_id, message, *, tempdir, python_version, formatted_path,
+    existing_patches,
+):
+    """Handle a single patch, moving it to `tempdir` and returning info
+
+    `message` is the full commit message (like `%B`).
+    `formatted_path` is the file where `git format-patch` wrote the commit.
+    `existing_patches` is the result of find_existing_patches().
+    """
+    message = message.strip()
     summary, _, message_body = message.partition('\n')
     match = PATCH_NUMBER_RE.match(summary)
     if match:
         number = int(match.group(1))
-        paths = list(Path('.').glob(f'{number:05d}-*.patch'))
+        paths = existing_patches.get(f'{number:05d}', [])
         if len(paths) == 0:
             path = Path(slugify(summary) + '.patch')
         elif len(paths) == 1:
@@ -88,11 +181,11 @@ def handle_patch(repo, commit_id, *, tempdir, python_version):
         else:
             paths_msg = ''.join(f'\n   {p}' for p in paths)
             exit(
-                'More than one patch file matches {number}: {paths_msg}'
+                f'More than one patch file matches {number}: {paths_msg}'
             )
     elif summary.endswith('.patch') and FLIENAME_SAFE_RE.match(summary):
         path = Path(summary)
-        match = re.search('\d{5,}', message)
+        match = PATCH_NUM_IN_BODY_RE.search(message)
         if match:
             number = int(str(match.group(0)))
         elif summary in SPECIAL_PATCH_NUMBERS:
@@ -107,35 +200,25 @@ def handle_patch(repo, commit_id, *, tempdir, python_version):
         )
 
     patch_path = tempdir / path.name
+    formatted_path.replace(patch_path)
 
-    abbrev = ABBREV.get(python_version, ABBREV[...])
-
-    with open(patch_path, 'w') as f:
-        proc = run(
-            'git', 'format-patch', '--stdout', '-1',
-            '--minimal', '--patience', f'--abbrev={abbrev}', '--find-renames',
-            '--zero-commit', '--no-signature',
-            commit_id,
-            cwd=repo, stdout=f
-        )
-
-    with open(patch_path) as f:
-        hash_id = run('git', 'patch-id', '--stable', stdin=f).stdout.split()[0]
+    patch = patch_path.read_bytes()
+    hash_id = compute_patch_id(patch)
 
     spec_comment = []
     if summary.endswith('.patch'):
-        message_body = removeprefix(message_body.strip(), f'{number:05d} #\n')
+        message_body = message_body.strip().removeprefix(f'{number:05d} #\n')
     else:
-        spec_comment.append(re.sub(PATCH_NUMBER_RE, '', summary))
+        spec_comment.append(PATCH_NUMBER_RE.sub('', summary))
     for line in message_body.splitlines():
-        if line.lower().startswith('co-authored-by:'):
+        if COAUTHOR_RE.match(line):
             continue
-        if re.fullmatch(r'\(cherry picked from commit .{40}\)', line):
+        if CHERRY_PICKED_RE.fullmatch(line):
             continue
         spec_comment.append(line)
 
     if number == 189 and (python_version >= (3, 6) or python_version == (3,)):
-        trailer = process_rpmwheels_patch(tempdir / path.name)
+        trailer = process_rpmwheels_patch(patch.decode('utf-8'))
     else:
         trailer = ''
 
@@ -145,27 +228,131 @@ def handle_patch(repo, commit_id, *, tempdir, python_version):
     )
 
 
+def compute_patch_id(patch):
+    """Return the ID of a patch given as bytes, like `git patch-id --stable`
+
+    This mirrors git's algorithm: each file's diff is hashed with SHA-1,
+    ignoring whitespace, hunk line numbers and `index` lines, and the
+    hashes are summed as little-endian 160-bit integers.
+    Only the first patch in the input is considered.
+    """
+    total = 0
+    sha = hashlib.sha1()
+    def flush_one_hunk():
+        nonlocal total, sha
+        total += int.from_bytes(sha.digest(), 'little')
+        sha = hashlib.sha1()
+
+    patchlen = 0
+    before = after = -1
+    diff_is_binary = False
+    pre_oid = post_oid = b''
+    # Like git, only split on "\n"; a lone "\r" is part of the line
+    for line in io.BytesIO(patch):
+        # Skip "\ No newline at end of file"
+        if line.startswith(b'\\ ') and len(line) > 12:
+            continue
+
+        # A commit ID ("From <id>" from format-patch) starts a new patch
+        if PATCH_ID_COMMIT_RE.match(line):
+            if patchlen:
+                break
+            continue
+
+        # Ignore commit comments
+        if not patchlen and not line.startswith(b'diff '):
+            continue
+
+        # Parsing diff header?
+        if before == -1:
+            if line.startswith((b'GIT binary patch', b'Binary files')):
+                diff_is_binary = True
+                before = 0
+                sha.update(pre_oid)
+                sha.update(post_oid)
+                flush_one_hunk()
+                continue
+            elif line.startswith(b'index '):
+                oid1_end = line.find(b'..')
+                if oid1_end != -1:
+                    oid2_end = line.find(b' ', oid1_end)
+                    if oid2_end == -1:
+                        oid2_end = len(line) - 1
+                    pre_oid = line[len(b'index '):oid1_end]
+                    post_oid = line[oid1_end + 2:oid2_end]
+                continue
+            elif line.startswith(b'--- '):
+                before = after = 1
+            elif not line[:1].isalpha():
+                break
+
+        if diff_is_binary:
+            if line.startswith(b'diff '):
+                diff_is_binary = False
+                before = -1
+            continue
+
+        # Looking for a valid hunk header?
+        if before == 0 and after == 0:
+            if match := HUNK_HEADER_RE.match(line):
+                # Parse next hunk, but ignore line numbers
+                before = int(match['before'] or 1)
+                after = int(match['after'] or 1)
+                continue
+
+            # Split at the end of the patch
+            if not line.startswith(b'diff '):
+                break
+
+            # Else we're parsing another header
+            flush_one_hunk()
+            before = after = -1
+
+        # If we get here, we're inside a hunk
+        if line[:1] in (b'-', b' '):
+            before -= 1
+        if line[:1] in (b'+', b' '):
+            after -= 1
+
+        line = line.translate(None, b' \t\n\r')
+        patchlen += len(line)
+        sha.update(line)
+
+    flush_one_hunk()
+    return (total % 2**160).to_bytes(20, 'little').hex()
+
+
+def find_existing_patches():
+    """Return patch files in the current directory, keyed by number prefix
+
+    Keys are the digits before the first dash, e.g. '00189' for
+    '00189-use-rpm-wheels.patch'. Values are lists of Paths.
+    """
+    result = {}
+    for path in Path('.').glob('*.patch'):
+        if match := EXISTING_PATCH_RE.match(path.name):
+            result.setdefault(match.group(1), []).append(path)
+    return result
+
+
 def slugify(string):
     """Massage a string for filename safety
 
     This should be similar to how git-format-patch generates filenames.
     """
-    return re.sub('[^a-z0-9_-]+', '-', string.lower()).strip('-')
+    return SLUGIFY_RE.sub('-', string.lower()).strip('-')
 
 
-def process_rpmwheels_patch(path):
+def process_rpmwheels_patch(patch):
     """Return a "trailer" with %global definitions for patch 189
+
+    `patch` is the text of the patch.
     """
     versions = {}
-    with path.open() as f:
-        for line in f:
-            if line.startswith('-_'):
-                print(line, BUNDLED_VERSION_RE)
-            match = BUNDLED_VERSION_RE.match(line.strip())
-            if match:
-                if match[1] in versions:
-                    exit(f'Bundled version for {match[1]} appears twice')
-                versions[match[1]] = match[2]
+    for match in BUNDLED_VERSION_RE.finditer(patch):
+        if match[1] in versions:
+            exit(f'Bundled version for {match[1]} appears twice')
+        versions[match[1]] = match[2]
     version_lines = (
         f'%global {name.lower()}_version {ver}\n'
         for name, ver in sorted(versions.items())
@@ -173,20 +360,16 @@ def process_rpmwheels_patch(path):
     return BUNDLED_VERSION_BLURB + ''.join(version_lines)
 
 
-def run(*args, echo_stdout=True, **kwargs):
-    """Like subprocess.run, but with logging and more appropriate defaults"""
-    kwargs.setdefault('check', True)
-    kwargs.setdefault('encoding', 'utf-8')
-    kwargs.setdefault('stdout', subprocess.PIPE)
-
-    prompt = click.style(f'{kwargs.get("cwd", "")}$ ', fg='cyan')
+def echo_command(args, kwargs):
+    """Log a command about to be run with the given subprocess kwargs"""
+    prompt = style(f'{kwargs.get("cwd", "")}$ ', fg='cyan')
     redirs = []
     def add_redir(kwarg_name, symbol):
         stream = kwargs.get(kwarg_name)
         name = getattr(stream, 'name', None)
         if name:
             note = f' {symbol} {shlex.quote(name)}'
-            redirs.append(click.style(note, fg='cyan'))
+            redirs.append(style(note, fg='cyan'))
     add_redir('stdin', '<')
     add_redir('stdout', '>')
     click.echo(
@@ -194,17 +377,78 @@ def run(*args, echo_stdout=True, **kwargs):
         err=True,
     )
 
+
+def run(*args, echo_stdout=True, **kwargs):
+    """Like subprocess.run, but with logging and more appropriate defaults
+
+    Output is returned as bytes (unless `encoding` is given), so callers
+    decode only what they need as text.
+    With echo_stdout=False, only the number of output lines is logged;
+    with echo_stdout=None, nothing is (the caller reports the output).
+    """
+    kwargs.setdefault('check', True)
+    kwargs.setdefault('stdout', subprocess.PIPE)
+
+    echo_command(args, kwargs)
+
     result = subprocess.run(args, **kwargs)
 
     if result.stdout != None and result.stdout.strip():
         if echo_stdout:
             click.echo(result.stdout, err=True)
-        else:
-            lines = result.stdout.count("\n")
+        elif echo_stdout is not None:
+            lines = len(result.stdout.splitlines())
             click.echo(f'[{lines} lines]\n', err=True)
     return result
 
 
+@functools.lru_cache(maxsize=None)
+def rpm_eval(expression, rpm_globals):
+    """Expand an RPM expression, with the given tuple of macro definitions
+
+    The definitions are passed in a macro file rather than as one -D
+    argument each, so the command line stays short even for large specs.
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.macros') as f:
+        f.writelines(f'%{definition}\n' for definition in rpm_globals)
+        f.flush()
+        return run(
+            'rpm', f'--load={f.name}', '--eval', expression,
+        ).stdout.decode('utf-8').strip()
+
+
+def cached_on_disk(kind, key, compute):
+    """Return the result of compute(), caching it in CACHE_DIR/kind/key
+
+    The key should be a hash of all inputs, so stale entries are never used.
+    Caching is best-effort: errors writing the cache are ignored.
+    """
+    path = CACHE_DIR / kind / key
+    try:
+        return path.read_text()
+    except OSError:
+        pass
+    result = compute()
+    # Write to a temporary file and rename it, so that a concurrent
+    # run never reads a partially written entry
+    temp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            'w', dir=path.parent, prefix='.tmp-', delete=False,
+        ) as f:
+            temp_path = Path(f.name)
+            f.write(result)
+        os.replace(temp_path, path)
+    except OSError:
+        if temp_path is not None:
+            try:
+                temp_path.unlink()
+            except OSError:
+                pass
+    return result
+
+
 @click.command(context_settings={'help_option_names': ['-h', '--help']})
 @click.option(
     '-r', '--repo', default=None, metavar='REPO',
@@ -267,8 +511,10 @@ def main(spec, repo, base, head, python_version):
 
     There is no "dry run" option; commit/stash your work before running this.
     """
-    with tempfile.TemporaryDirectory() as d:
-        tempdir = Path(d)
+    # The temporary directory is on the same filesystem as the
+    # current directory, so the results can be moved by renaming
+    with tempfile.TemporaryDirectory(dir='.', prefix='.importpatches-') as d:
+        tempdir = Path(d).resolve()
         if spec == None:
             specs = list(Path('.').glob('*.spec'))
             if len(specs) != 1:
@@ -277,7 +523,7 @@ def main(spec, repo, base, head, python_version):
                     "directory, or SPEC must be given."
                 )
             spec = specs[0].resolve()
-            click.secho(f'Assuming SPEC is {spec}', fg='yellow')
+            secho(f'Assuming SPEC is {spec}', fg='yellow')
 
         if python_version is None:
             if spec.name.startswith('python') and spec.name.endswith('.spec'):
@@ -287,7 +533,7 @@ def main(spec, repo, base, head, python_version):
                     # "python36.spec" -> python_version="3.6"
                     # "python3.spec" -> python_version="3"
                     python_version = '.'.join(python_version)
-                click.secho(
+                secho(
                     f'Assuming --python-version={python_version}',
                     fg='yellow'
                 )
@@ -296,12 +542,11 @@ def main(spec, repo, base, head, python_version):
                     "Cound not get version from spec name. " +
                     "Specify --python-version expliticly."
                 )
-        try:
-            python_version = tuple(int(c) for c in python_version.split('.'))
-        except ValueError:
+        if not VERSION_RE.fullmatch(python_version):
             raise click.UsageError(
                 "--python-version must be dot-separated integers."
             )
+        python_version = tuple(int(c) for c in python_version.split('.'))
 
         if repo == None:
             proc = run(
@@ -315,54 +560,67 @@ def main(spec, repo, base, head, python_version):
                     f'specify --repo explicitly.'
                 )
             proc.check_returncode()
-            repo = proc.stdout.strip()
-            click.secho(f'Assuming --repo={repo}', fg='yellow')
+            repo = proc.stdout.decode('utf-8').strip()
+            secho(f'Assuming --repo={repo}', fg='yellow')
+
+        spec_text = spec.read_text()
+        spec_key = hashlib.blake2b(
+            spec_text.encode(), digest_size=16
+        ).hexdigest()
+        spec_lines = spec_text.splitlines(keepends=True)
+        spec_info = scan_spec(spec_lines)
 
         if base == None:
-            with spec.open() as f:
-                rpm_globals = []
-                for line in f:
-                    line = line.strip()
-                    if line.startswith('%global ') and '%{expand:' not in line:
-                        rpm_globals.append(removeprefix(line, '%global '))
-                    if line.startswith('%global upstream_version'):
-                        upstream_version = run(
-                            'rpm',
-                            *(f'-D{d}' for d in rpm_globals),
-                            '--eval', '%upstream_version'
-                        ).stdout.strip()
-                        base = f'v{upstream_version}'
-                        break
-                else:
-                    raise click.UsageError(
-                        "Tag of upstream release not found in spec; check " +
-                        "logic in the script or specify --base explicitly."
-                    )
-            click.secho(f'Assuming --base={base}', fg='yellow')
+            upstream_version = spec_info.upstream_version
+            if upstream_version is None:
+                raise click.UsageError(
+                    "Tag of upstream release not found in spec; check " +
+                    "logic in the script or specify --base explicitly."
+                )
+            if not upstream_version or '%' in upstream_version:
+                # The definition uses macros; let rpm expand it
+                upstream_version = cached_on_disk(
+                    'upstream_version', spec_key,
+                    lambda: rpm_eval(
+                        '%upstream_version', tuple(spec_info.rpm_globals),
+                    ),
+                )
+            base = f'v{upstream_version}'
+            secho(f'Assuming --base={base}', fg='yellow')
 
         if head == None:
-            release = run(
-                'rpm',
-                '--undefine=dist',
-                '--queryformat=%{release}\n',
-                '--specfile', str(spec),
-            ).stdout.splitlines()[0]
+            release = spec_info.literal_release or cached_on_disk(
+                'release', spec_key,
+                lambda: run(
+                    'rpm',
+                    '--undefine=dist',
+                    '--queryformat=%{release}\n',
+                    '--specfile', str(spec),
+                ).stdout.decode('utf-8').splitlines()[0],
+            )
             upstream_version = base.lstrip('v')
             head = f'fedora-{upstream_version}-{release}'
-            click.secho(f'Assuming --head={head}', fg='yellow')
+            secho(f'Assuming --head={head}', fg='yellow')
 
+        # Get commit IDs and messages in one walk; entries are
+        # NUL-separated since messages span several lines
         proc = run(
-            'git', 'rev-list', head, '^' + base,
-            cwd=repo, echo_stdout=False, check=False,
+            'git', 'rev-list', '--no-commit-header', '--format=%H%n%B%x00',
+            head, '^' + base,
+            cwd=repo, echo_stdout=None, check=False, stderr=subprocess.PIPE,
         )
         if proc.returncode != 0:
-            click.secho(
+            stderr = proc.stderr.decode('utf-8', errors='replace')
+            click.echo(stderr, err=True)
+            if '--no-commit-header' in stderr:
+                exit(GIT_TOO_OLD_MESSAGE)
+            secho(
                 "Expected commits were not found. " +
                 "Specify --base or --head explicitly.",
                 fg='red',
             )
             def cyan(text):
-                return click.style(text, fg='cyan')
+                return style(text, fg='cyan')
             click.secho("Or did you forget one of these?")
             cmd = f"rpmdev-bumpspec *.spec -c 'Update to {upstream_version}'"
             click.secho(f"- $ {cyan(cmd)}")
@@ -371,18 +629,49 @@ def main(spec, repo, base, head, python_version):
                 f"and tag as {cyan(head)}"
             )
             exit(1)
-        log = proc.stdout.splitlines()
+        log = []
+        for entry in proc.stdout.decode('utf-8').split('\0'):
+            commit_id, _, message = entry.lstrip('\n').partition('\n')
+            if commit_id and not COMMIT_ID_RE.fullmatch(commit_id):
+                exit(GIT_TOO_OLD_MESSAGE)
+            if commit_id:
+                log.append((commit_id, message))
+        click.echo(f'[{len(log)} commits]\n', err=True)
         if len(log) >= 100:
             exit(
                 'There are more than 100 patches. Probably a wrong branch ' +
                 'was selected; try giving -c explicitly.'
             )
 
-        patches_section = []
-        for commit_id in reversed(log):
+        # Format all patches with a single git process. With
+        # --numbered-files, they are named 1, 2, ... in the order
+        # of reversed(log), and cannot clash with the final *.patch names.
+        # The --no-* options make the output the same as formatting each
+        # commit alone (no "[PATCH n/m]", cover letter or threading).
+        abbrev = ABBREV.get(python_version, ABBREV[...])
+        run(
+            'git', 'format-patch', '--output-directory', str(tempdir),
+            '--numbered-files', '--no-numbered', '--no-cover-letter',
+            '--no-thread',
+            '--minimal', '--patience', f'--abbrev={abbrev}', '--find-renames',
+            '--zero-commit', '--no-signature',
+            head, '^' + base,
+            cwd=repo, echo_stdout=False,
+        )
+        formatted_paths = [tempdir / str(i) for i in range(1, len(log) + 1)]
+        if not all(p.exists() for p in formatted_paths):
+            exit('git format-patch did not produce a patch for every commit')
+
+        existing_patches = find_existing_patches()
+        patches_section = io.StringIO()
+        for (commit_id, message), formatted_path in zip(
+            reversed(log), formatted_paths,
+        ):
             result = handle_patch(
-                repo, commit_id, tempdir=tempdir,
+                commit_id, message, tempdir=tempdir,
                 python_version=python_version,
+                formatted_path=formatted_path,
+                existing_patches=existing_patches,
             )
             comment = '\n'.join(
                 f'# {l}' if l else '#' for l in result.comment.splitlines()
@@ -394,58 +683,56 @@ def main(spec, repo, base, head, python_version):
             """) % comment.replace('%', '%%')
             if result.trailer:
                 section = section.rstrip() + result.trailer
-            patches_section.append(section)
+            patches_section.write(section)
 
-        spec_lines = []
         outfile_path = tempdir / spec.name
-        keep_patches = KEEP_PATCHES.copy()
-        with open(outfile_path, 'w') as outfile:
-            with spec.open('r') as infile:
-                echoing = True
-                found_start = False
-                found_modern_start = False
-                for line in infile:
-                    if match := SOURCE_PATCH_RE.match(line.rstrip()):
-                        keep_patches.add(match.group('filename'))
-                    if line.rstrip() == PATCH_SECTION_END:
-                        echoing = True
-                    if line.rstrip() in PATCH_SECTION_STARTS:
-                        is_modern = (line.rstrip() == PATCH_SECTION_START)
-                        if found_start:
-                            if found_modern_start and not is_modern:
-                                # Specfile was already converted
-                                if echoing:
-                                    outfile.write(line)
-                                continue
-                            else:
-                                exit('Spec has multiple starts of section')
-                        found_start = True
-                        if is_modern:
-                            found_modern_start = True
-                        echoing = False
-                        outfile.write(PATCH_SECTION_START + '\n')
-                        outfile.writelines(patches_section)
-                        outfile.write('\n')
-                    if echoing:
-                        outfile.write(line)
+        keep_patches = KEEP_PATCHES | spec_info.source_patches
+        with open(outfile_path, 'w', buffering=IO_BUFFER_SIZE) as outfile:
+            echoing = True
+            found_start = False
+            found_modern_start = False
+            for line in spec_lines:
+                stripped = line.rstrip()
+                if stripped == PATCH_SECTION_END:
+                    echoing = True
+                if stripped in PATCH_SECTION_STARTS:
+                    is_modern = (stripped == PATCH_SECTION_START)
+                    if found_start:
+                        if found_modern_start and not is_modern:
+                            # Specfile was already converted
+                            if echoing:
+                                outfile.write(line)
+                            continue
+                        else:
+                            exit('Spec has multiple starts of section')
+                    found_start = True
+                    if is_modern:
+                        found_modern_start = True
+                    echoing = False
+                    outfile.write(PATCH_SECTION_START + '\n')
+                    outfile.write(patches_section.getvalue())
+                    outfile.write('\n')
+                if echoing:
+                    outfile.write(line)
 
         if not found_start:
             exit('Patches section not found in spec file')
         if not echoing:
             exit('End of patches section not found in spec file')
 
-        click.secho(f'Updating patches and spec', fg='yellow')
+        secho(f'Updating patches and spec', fg='yellow')
 
-        # Remove all existing patches
+        # Remove existing patches, except those about to be overwritten
+        keep_patches |= {path.name for path in tempdir.iterdir()}
         for path in Path('.').glob('*.patch'):
             if path.name not in keep_patches:
                 path.unlink()
 
         # Move all files from tempdir to current directory
         for path in tempdir.iterdir():
-            shutil.move(path, path.name)
+            os.replace(path, path.name)
 
-    click.secho('OK', fg='green')
+    secho('OK', fg='green')
 
 
 if __name__ == '__main__':
@@ -454,5 +741,5 @@ if __name__ == '__main__':
     except SystemExit as e:
         if e.code != None:
             raise
-        click.secho(f"{e}", fg='red')
+        secho(f"{e}", fg='red')
         raise SystemExit(1)